@@ -0,0 +1,8 @@
+import frappe
+
+
+def execute():
+    """Add a composite index on Employee Checkin (employee, time) so the
+    per-employee latest-checkin lookups used by the MSSQL sync resolve
+    with an index probe instead of a scan and sort."""
+    frappe.db.add_index("Employee Checkin", ["employee", "time"], index_name="idx_empcheckin_emp_time")